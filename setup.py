@@ -1,47 +1,89 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import sys
 
-def main():
-    from setuptools import setup, find_packages
-
-    kwargs = {
-        'name': 'TracPygit2Plugin',
-        'version': '0.12.0.1',
-        'description': 'Pygit2 integration for Git repository on Trac 0.12+',
-        'license': 'BSD',  # the same as Trac
-        'url': 'http://trac-hacks.org/wiki/TracPygit2Plugin',
-        'author': 'Jun Omae',
-        'author_email': 'jun66j5@gmail.com',
-        'packages': find_packages(exclude=['*.tests*']),
-        'package_data': {
-            'tracext.pygit2': ['locale/*/LC_MESSAGES/*.mo'],
-        },
-        'test_suite': 'tracext.pygit2.tests.suite',
-        'zip_safe': False,
-        'install_requires': ['Trac', 'pygit2'],
-        'entry_points': {
-            'trac.plugins': [
-                'tracext.pygit2.pygit2_fs = tracext.pygit2.pygit2_fs',
-                'tracext.pygit2.translation = tracext.pygit2.translation',
-            ],
-        },
-    }
+from setuptools import setup
+
+# commands which may run `build` and `install_lib` overridden by
+# `get_l10n_cmdclass()`
+_l10n_commands = ('build', 'install', 'bdist', 'develop', 'easy_install',
+                  'check_catalog')
+# commands which use `message_extractors`
+_extract_commands = ('extract_messages',)
+
+_setup_kwargs = {
+    'name': 'TracPygit2Plugin',
+    'version': '0.12.0.1',
+    'description': 'Pygit2 integration for Git repository on Trac 0.12+',
+    'license': 'BSD',  # the same as Trac
+    'url': 'http://trac-hacks.org/wiki/TracPygit2Plugin',
+    'author': 'Jun Omae',
+    'author_email': 'jun66j5@gmail.com',
+    'packages': ['tracext', 'tracext.pygit2'],
+    'package_data': {
+        'tracext.pygit2': ['locale/*/LC_MESSAGES/*.mo'],
+    },
+    'zip_safe': False,
+    'install_requires': ['Trac', 'pygit2'],
+    'entry_points': {
+        'trac.plugins': [
+            'tracext.pygit2.pygit2_fs = tracext.pygit2.pygit2_fs',
+            'tracext.pygit2.translation = tracext.pygit2.translation',
+        ],
+    },
+}
+
+
+def _has_command(args, names):
+    return any(arg.startswith(names) for arg in args
+               if not arg.startswith('-'))
+
+
+def _has_catalogs(locale_dir='tracext/pygit2/locale'):
+    """Return `True` if at least one `.po` catalog exists in `locale_dir`."""
     try:
-        import babel
-        from trac.util.dist import get_l10n_cmdclass
-    except ImportError:
-        pass
-    else:
-        from glob import glob
-        if glob('tracext/pygit2/locale/*/LC_MESSAGES/*.po'):
-            kwargs['message_extractors'] = {
-                'tracext': [
-                    ('**.py', 'python', None),
-                    ('**.html', 'genshi', None),
-                ],
-            }
-            kwargs['cmdclass'] = get_l10n_cmdclass()
+        locales = os.listdir(locale_dir)
+    except OSError:
+        return False
+    for locale in locales:
+        messages_dir = os.path.join(locale_dir, locale, 'LC_MESSAGES')
+        try:
+            names = os.listdir(messages_dir)
+        except OSError:
+            continue
+        for name in names:
+            if name.endswith('.po'):
+                return True
+    return False
+
+
+def main():
+    kwargs = dict(_setup_kwargs)
+    args = sys.argv[1:]
+    if _has_command(args, ('test',)):
+        kwargs['test_suite'] = 'tracext.pygit2.tests.suite'
+    use_l10n = _has_command(args, _l10n_commands)
+    use_extractors = _has_command(args, _extract_commands)
+    if use_l10n or use_extractors:
+        try:
+            from trac.util.dist import get_l10n_cmdclass
+        except ImportError:
+            pass
+        else:
+            if _has_catalogs():
+                if use_extractors:
+                    kwargs['message_extractors'] = {
+                        'tracext': [
+                            ('**.py', 'python', None),
+                            ('**.html', 'genshi', None),
+                        ],
+                    }
+                if use_l10n:
+                    cmdclass = get_l10n_cmdclass()
+                    if cmdclass:  # None without Babel
+                        kwargs['cmdclass'] = cmdclass
 
     setup(**kwargs)
 
@@ -7,9 +7,10 @@
 # you should have received as part of this distribution.
 
 import os
-import posixpath
+import time
 from cStringIO import StringIO
 from datetime import datetime
+from operator import itemgetter
 from threading import RLock
 
 try:
@@ -79,6 +80,13 @@ __all__ = ['GitCachedRepository', 'GitCachedChangeset', 'GitConnector',
 
 _filemode_submodule = 0160000
 _diff_find_rename_limit = 200
+_tree_entry_cache_size = 8192
+_rev_cache_size = 1024
+_blame_cache_size = 64
+_branches_cache_size = 1024
+_node_change_rows_per_insert = 100
+_sync_tips_per_query = 100
+_refs_racy_seconds = 2
 
 if pygit2:
     _status_map = {'A': Changeset.ADD, 'D': Changeset.DELETE,
@@ -88,8 +96,17 @@ if pygit2:
         _get_filemode = lambda tree_entry: tree_entry.filemode
     else:
         _get_filemode = lambda tree_entry: tree_entry.attributes
+    if hasattr(pygit2.Commit, 'parent_ids'):
+        _get_parent_ids = lambda commit: commit.parent_ids
+    else:
+        _get_parent_ids = lambda commit: [c.oid for c in commit.parents]
     _walk_flags = GIT_SORT_TIME
-    if not hasattr(pygit2.Patch, 'delta'):  # prior to v0.22.1
+    if hasattr(pygit2.Diff, 'deltas'):
+        # iterating deltas doesn't generate the patch for each file
+        def _iter_changes_from_diff(diff):
+            for delta in diff.deltas:
+                yield delta.old_file.path, delta.new_file.path, delta.status
+    elif not hasattr(pygit2.Patch, 'delta'):  # prior to v0.22.1
         def _iter_changes_from_diff(diff):
             for patch in diff:
                 yield patch.old_file_path, patch.new_file_path, patch.status
@@ -129,6 +146,25 @@ else:
         raise ValueError('Unsupported database "%s"' % uri.split(':')[0])
 
 
+def _is_postgres(env):
+    return env.config.get('trac', 'database', '').startswith('postgres:')
+
+
+def _node_change_inserts(rows, size=None):
+    """Yield `(sql, args)` inserting `rows` into the `node_change` table
+    with multi-row VALUES, at most `size` rows per statement.
+    """
+    if size is None:
+        size = _node_change_rows_per_insert
+    for idx in xrange(0, len(rows), size):
+        chunk = rows[idx:idx + size]
+        sql = ('INSERT INTO node_change '
+               '(repos,rev,path,node_type,change_type,base_path,base_rev) '
+               'VALUES ' +
+               ','.join(['(%s,%s,%s,%s,%s,%s,%s)'] * len(chunk)))
+        yield sql, [value for row in chunk for value in row]
+
+
 class GitCachedRepository(CachedRepository):
     """Git-specific cached repository."""
 
@@ -188,69 +224,121 @@ class GitCachedRepository(CachedRepository):
 
         IntegrityError = _db_exc(self.env).IntegrityError
         cursor = db.cursor()
-
-        def is_synced(rev):
-            cursor.execute("SELECT COUNT(repos) FROM revision "
-                           "WHERE repos=%s AND rev=%s",
-                           (self.id, rev))
-            row = cursor.fetchone()
-            return row[0] > 0
-
-        def traverse(commit, seen):
+        # keep the raw 20-bytes oids rather than hex strings
+        synced = set()
+        synced_loaded = False
+
+        def load_synced_tips(refs):
+            size = _sync_tips_per_query
+            for idx in xrange(0, len(refs), size):
+                revs = [oid.hex for name, oid, commit_time
+                                in refs[idx:idx + size]]
+                cursor.execute("SELECT rev FROM revision "
+                               "WHERE repos=%%s AND rev IN (%s)" %
+                               ','.join(['%s'] * len(revs)),
+                               [self.id] + revs)
+                synced.update(str(row[0]).decode('hex') for row in cursor)
+
+        def load_synced():
+            cursor.execute("SELECT rev FROM revision WHERE repos=%s",
+                           (self.id,))
+            synced.update(str(row[0]).decode('hex') for row in cursor)
+
+        def traverse(oid, seen):
+            """Return the unsynced commits reachable from `oid`, parents
+            before children.
+            """
             commits = []
-            merges = []
-            while True:
-                rev = commit.hex
-                if rev in seen:
-                    break
-                seen.add(rev)
-                if is_synced(rev):
-                    break
-                commits.append(commit)
-                parents = commit.parents
-                if not parents:  # root commit?
-                    break
-                commit = parents[0]
-                if len(parents) > 1:
-                    merges.append((len(commits), parents[1:]))
-            for idx, parents in reversed(merges):
-                for parent in parents:
-                    commits[idx:idx] = traverse(parent, seen)
+            stack = [(True, oid)]  # (visit?, oid to visit or commit to add)
+            while stack:
+                visit, item = stack.pop()
+                if not visit:
+                    commits.append(item)
+                    continue
+                oid = item
+                # follow the first parents, then the other parents of each
+                # merge are visited before the merge commit itself is added
+                while True:
+                    raw = oid.raw
+                    if raw in seen:
+                        break
+                    seen.add(raw)
+                    if raw in synced:
+                        break
+                    commit = git_repos[oid]
+                    stack.append((False, commit))
+                    parent_ids = _get_parent_ids(commit)
+                    if not parent_ids:  # root commit?
+                        break
+                    oid = parent_ids[0]
+                    for parent_id in reversed(parent_ids[1:]):
+                        stack.append((True, parent_id))
             return commits
 
+        batch_size = max(1, GitConnector(self.env).sync_batch_size)
+        updated = [False]
+
+        def prepare_batch(batch):
+            # compute the tree diffs before opening the transaction, so
+            # that it only covers the inserts
+            return [(commit.hex,
+                     _PreparedChangeset(GitChangeset(repos, commit)))
+                    for commit in batch]
+
+        def insert_batch(batch):
+            @self.env.with_transaction()
+            def do_insert(db):
+                for rev, cset in batch:
+                    self.log.info("Trying to sync revision [%s]", rev)
+                    self._insert_cset(db, rev, cset)
+
+        def insert_commit(rev, cset):
+            self.log.info("Trying to sync revision [%s]", rev)
+            @self.env.with_transaction()
+            def do_insert(db):
+                try:
+                    self._insert_cset(db, rev, cset)
+                    updated[0] = True
+                except IntegrityError, e:
+                    self.log.info('Revision %s already cached: %r', rev, e)
+                    db.rollback()
+
         while True:
             repos_youngest = repos.youngest_rev or ''
-            updated = [False]
+            updated[0] = False
             seen = set()
 
-            for name in git_repos.listall_references():
-                ref = git_repos.lookup_reference(name)
-                git_object = ref.get_object()
-                type_ = git_object.type
-                if type_ == GIT_OBJ_TAG:
-                    git_object = git_object.get_object()
-                    type_ = git_object.type
-                if type_ != GIT_OBJ_COMMIT:
+            refs = [ref for ref in repos._get_refs()
+                        if ref[1].raw not in synced]
+            if refs and not synced_loaded:
+                # look at the tips first, the cached revisions are only
+                # needed when there is something to traverse
+                load_synced_tips(refs)
+                refs = [ref for ref in refs if ref[1].raw not in synced]
+                if refs:
+                    load_synced()
+                    synced_loaded = True
+
+            for name, oid, commit_time in refs:
+                if oid.raw in synced:
                     continue
-
-                commits = traverse(git_object, seen)  # topology ordered
-                while commits:
-                    # sync revision from older revision to newer revision
-                    commit = commits.pop()
-                    rev = commit.hex
-                    self.log.info("Trying to sync revision [%s]", rev)
-                    cset = GitChangeset(repos, commit)
-                    @self.env.with_transaction()
-                    def do_insert(db):
-                        try:
-                            self._insert_cset(db, rev, cset)
-                            updated[0] = True
-                        except IntegrityError, e:
-                            self.log.info('Revision %s already cached: %r',
-                                          rev, e)
-                            db.rollback()
+                commits = traverse(oid, seen)  # topology ordered
+                # sync revision from older revision to newer revision
+                for idx in xrange(0, len(commits), batch_size):
+                    batch = commits[idx:idx + batch_size]
+                    prepared = prepare_batch(batch)
+                    try:
+                        insert_batch(prepared)
+                    except IntegrityError:
+                        for rev, cset in prepared:
+                            insert_commit(rev, cset)
+                    else:
+                        updated[0] = True
+                    for commit in batch:
+                        synced.add(commit.oid.raw)
                     if feedback:
-                        feedback(rev)
+                        for commit in batch:
+                            feedback(commit.hex)
 
             if updated[0]:
                 continue  # sync again
@@ -342,17 +430,29 @@ class GitCachedRepository(CachedRepository):
                 VALUES (%s,%s,%s,%s,%s)
                 """, (self.id, srev, to_utimestamp(cset.date),
                       cset.author, cset.message))
+            kindmap = _inverted_kindmap
+            actionmap = _inverted_actionmap
+            debug = self.log.debug
+            rows = []
             for path, kind, action, bpath, brev in cset.get_changes():
-                self.log.debug("Caching node change in [%s]: %r", rev,
-                               (path, kind, action, bpath, brev))
-                kind = _inverted_kindmap[kind]
-                action = _inverted_actionmap[action]
-                cursor.execute("""
+                debug("Caching node change in [%s]: %r", rev,
+                      (path, kind, action, bpath, brev))
+                rows.append((self.id, srev, path, kindmap[kind],
+                             actionmap[action], bpath, brev))
+            if not rows:
+                return
+            if not _is_postgres(self.env):
+                cursor.executemany("""
                     INSERT INTO node_change
                         (repos,rev,path,node_type,change_type,base_path,
                          base_rev)
                     VALUES (%s,%s,%s,%s,%s,%s,%s)
-                    """, (self.id, srev, path, kind, action, bpath, brev))
+                    """, rows)
+                return
+            # psycopg2's executemany() runs one statement per row, so send
+            # multi-row VALUES instead
+            for sql, args in _node_change_inserts(rows):
+                cursor.execute(sql, args)
 
 
 class GitCachedChangeset(CachedChangeset):
@@ -365,6 +465,22 @@ class GitCachedChangeset(CachedChangeset):
         return self.repos.repos._get_tags_cset(self.rev)
 
 
+class _PreparedChangeset(object):
+    """Changeset whose changes are computed up front, for caching it."""
+
+    __slots__ = ('rev', 'message', 'author', 'date', 'changes')
+
+    def __init__(self, cset):
+        self.rev = cset.rev
+        self.message = cset.message
+        self.author = cset.author
+        self.date = cset.date
+        self.changes = list(cset.get_changes())
+
+    def get_changes(self):
+        return iter(self.changes)
+
+
 def intersperse(sep, iterable):
     """The 'intersperse' generator takes an element and an iterable and
     intersperses that element between the elements of the iterable.
@@ -378,63 +494,88 @@ def intersperse(sep, iterable):
         yield item
 
 
+_tz_cache = {0: utc}
+
+
 def _git_timestamp(ts, offset):
-    if offset == 0:
-        tz = utc
-    else:
+    tz = _tz_cache.get(offset)
+    if tz is None:
         hours, rem = divmod(abs(offset), 60)
         tzname = 'UTC%+03d:%02d' % ((hours, -hours)[offset < 0], rem)
-        tz = FixedOffset(offset, tzname)
+        tz = _tz_cache[offset] = FixedOffset(offset, tzname)
     return datetime.fromtimestamp(ts, tz)
 
 
+_signature_cache = {}
+_signature_cache_size = 4096
+
+
 def _format_signature(signature):
-    name = signature.name.strip()
-    email = signature.email.strip()
-    return ('%s <%s>' % (name, email)).strip()
+    key = (signature.name, signature.email)
+    value = _signature_cache.get(key)
+    if value is None:
+        name = signature.name.strip()
+        email = signature.email.strip()
+        value = ('%s <%s>' % (name, email)).strip()
+        if len(_signature_cache) >= _signature_cache_size:
+            _signature_cache.clear()
+        _signature_cache[key] = value
+    return value
 
 
 def _walk_tree(repos, tree, path=None):
-    for entry in tree:
-        if _get_filemode(entry) == _filemode_submodule:
-            continue
-        git_object = repos.get(entry.oid)
-        if git_object is None:
-            continue
-        if path is not None:
-            name = posixpath.join(path, entry.name)
-        else:
-            name = entry.name
-        if git_object.type == GIT_OBJ_TREE:
-            for val in _walk_tree(repos, git_object, name):
-                yield val
-        else:
-            yield git_object, name
+    """Yield `(git_object, path)` for each blob under `tree`, skipping
+    submodules. Sub-trees are visited with an explicit stack rather than
+    recursion, so the entries are not yielded in tree order.
+    """
+    get_object = repos.get
+    get_filemode = _get_filemode
+    filemode_submodule = _filemode_submodule
+    obj_tree = GIT_OBJ_TREE
+    stack = [(tree, path)]
+    while stack:
+        tree, path = stack.pop()
+        for entry in tree:
+            if get_filemode(entry) == filemode_submodule:
+                continue
+            git_object = get_object(entry.oid)
+            if git_object is None:
+                continue
+            if path is not None:
+                name = path + '/' + entry.name
+            else:
+                name = entry.name
+            if git_object.type == obj_tree:
+                stack.append((git_object, name))
+            else:
+                yield git_object, name
 
 
 class _CachedWalker(object):
 
-    __slots__ = ('rev', 'walker', 'revs', 'commits', '_lock')
+    __slots__ = ('git_repos', 'walker', 'revs', 'oids', '_lock')
 
     def __init__(self, git_repos, rev, flags=_walk_flags):
-        self.rev = rev
+        self.git_repos = git_repos
         self.walker = git_repos.walk(rev, flags)
-        self.revs = set()
-        self.commits = []
+        self.revs = {}  # oid -> index in self.oids
+        self.oids = []
         self._lock = RLock()
 
     def __contains__(self, rev):
+        oid = pygit2.Oid(hex=str(rev))
         self._lock.acquire()
         try:
-            if rev in self.revs:
+            revs = self.revs
+            if oid in revs:
                 return True
-            add_rev = self.revs.add
-            add_commit = self.commits.append
+            oids = self.oids
+            add_oid = oids.append
             for commit in self.walker:
-                old_rev = commit.hex
-                add_commit(commit)
-                add_rev(old_rev)
-                if old_rev == rev:
+                commit_oid = commit.oid
+                revs[commit_oid] = len(oids)
+                add_oid(commit_oid)
+                if commit_oid == oid:
                     return True
             return False
         finally:
@@ -444,12 +585,10 @@ class _CachedWalker(object):
         self._lock.acquire()
         try:
             if start_rev in self:
-                commits = self.commits
-                idx = len(commits) - 1
-                for idx in xrange(len(commits) - 1, -1, -1):
-                    commit = commits[idx]
-                    if commit.hex == start_rev:
-                        return reversed(commits[0:idx + 1])
+                git_repos = self.git_repos
+                oids = self.oids
+                idx = self.revs[pygit2.Oid(hex=str(start_rev))]
+                return (git_repos[oids[i]] for i in xrange(idx, -1, -1))
             return ()
         finally:
             self._lock.release()
@@ -558,6 +697,10 @@ class GitConnector(Component):
         git_fs_encoding = Option('git', 'git_fs_encoding', 'utf-8',
             N_("Define charset encoding of paths within git repositories."))
 
+    sync_batch_size = IntOption('git', 'sync_batch_size', 1000,
+        N_("Number of revisions inserted into the cache per transaction "
+           "while synchronizing a cached repository."))
+
     # IRepositoryConnector methods
 
     def get_supported_types(self):
@@ -610,12 +753,25 @@ class GitConnector(Component):
         """
         email = (signature.email or '').strip()
         if email:
-            email = email.lower()
-            for username, name, _email in self.env.get_known_users():
-                if _email and email == _email.lower():
-                    return username
+            username = self._get_email_map().get(email.lower())
+            if username:
+                return username
         return _format_signature(signature)
 
+    _email_map = (0, None)
+    _email_map_ttl = 60
+
+    def _get_email_map(self):
+        updated, email_map = self._email_map
+        now = time.time()
+        if email_map is None or not (0 <= now - updated < self._email_map_ttl):
+            email_map = {}
+            for username, name, email in self.env.get_known_users():
+                if email:
+                    email_map.setdefault(email.lower(), username)
+            self._email_map = (now, email_map)
+        return email_map
+
 
 class CsetPropertyRenderer(Component):
 
@@ -664,17 +820,22 @@ class CsetPropertyRenderer(Component):
         raise TracError("Internal error")
 
     def _render_branches(self, context, branches):
-        links = [self._changeset_link(context, rev, name)
+        repos = self._get_repository(context)
+        links = [self._changeset_link(context, rev, name, repos)
                  for name, rev in branches]
         return tag(*intersperse(', ', links))
 
     def _render_tags(self, context, names):
+        repos = self._get_repository(context)
         rev = context.resource.id
-        links = [self._changeset_link(context, rev, name) for name in names]
+        links = [self._changeset_link(context, rev, name, repos)
+                 for name in names]
         return tag(*intersperse(', ', links))
 
     def _render_revs(self, context, revs):
-        links = [self._changeset_link(context, rev) for rev in revs]
+        repos = self._get_repository(context)
+        links = [self._changeset_link(context, rev, repos=repos)
+                 for rev in revs]
         return tag(*intersperse(', ', links))
 
     def _render_merge_commit(self, context, revs):
@@ -682,9 +843,10 @@ class CsetPropertyRenderer(Component):
         curr_rev = context.resource.id
         reponame = context.resource.parent.id
         href = context.href
+        repos = self._get_repository(context)
 
         def parent_diff(rev):
-            link = self._changeset_link(context, rev)
+            link = self._changeset_link(context, rev, repos=repos)
             diff = tag.a(_("diff"),
                          href=href.changeset(curr_rev, reponame, old=rev),
                          title=_("Diff against this parent (show the changes "
@@ -707,10 +869,13 @@ class CsetPropertyRenderer(Component):
         return u'%s (%s)' % (chrome.format_author(req, signature.name),
                              user_time(req, format_datetime, dt))
 
-    def _changeset_link(self, context, rev, label=None):
+    def _get_repository(self, context):
+        return self.env.get_repository(context.resource.parent.id)
+
+    def _changeset_link(self, context, rev, label=None, repos=None):
         # `rev` is assumed to be a non-abbreviated 40-chars sha id
-        reponame = context.resource.parent.id
-        repos = self.env.get_repository(reponame)
+        if repos is None:
+            repos = self._get_repository(context)
         try:
             cset = repos.get_changeset(rev)
         except (NoSuchChangeset, NoSuchNode), e:
@@ -748,6 +913,14 @@ class GitRepository(Repository):
         self.use_committer_id = use_committer_id
         self.use_committer_time = use_committer_time
         self._ref_walkers = {}
+        self._ref_walkers_refs = None
+        self._refs_cache = None
+        self._ref_names = None
+        self._tags_by_rev = None
+        self._branches_cache = None
+        self._tree_entry_cache = {}
+        self._rev_cache = {}
+        self._blame_cache = {}
         Repository.__init__(self, 'git:' + path, self.params, log)
 
     def _from_fspath(self, name):
@@ -780,11 +953,27 @@ class GitRepository(Repository):
             return None
         if isinstance(path, unicode):
             path = self._to_fspath(path)
-        entry = tree
-        for name in path.split('/'):
-            if tree is None or tree.type != GIT_OBJ_TREE or name not in tree:
+        # trees are immutable, cache the entry (or `None` when missing) by
+        # `(tree oid, name)`; only entries are kept so that no tree
+        # objects stay alive because of the cache
+        cache = self._tree_entry_cache
+        names = path.split('/')
+        last = len(names) - 1
+        entry = None
+        for idx, name in enumerate(names):
+            if tree is None or tree.type != GIT_OBJ_TREE:
                 return None
-            entry = tree[name]
+            key = (tree.oid, name)
+            if key in cache:
+                entry = cache[key]
+            else:
+                if len(cache) >= _tree_entry_cache_size:
+                    cache.clear()
+                entry = cache[key] = tree[name] if name in tree else None
+            if entry is None:
+                return None
+            if idx == last:
+                break
             tree = self.git_repos.get(entry.oid)
         return entry
 
@@ -808,64 +997,182 @@ class GitRepository(Repository):
             return git_object
         return None
 
+    def _get_refs_key(self, refs_dirs):
+        """Return the mtimes of "packed-refs" and of `refs_dirs`, or `None`
+        if one of them is too recent to tell a later update apart.
+        """
+        # Updating a reference either rewrites "packed-refs" or renames a
+        # loose ref file into its directory, which modifies the mtime of
+        # that directory.
+        paths = [os.path.join(self.git_repos.path, 'packed-refs')]
+        paths.extend(refs_dirs)
+        racy = time.time() - _refs_racy_seconds
+        key = []
+        for path in paths:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                mtime = None
+            else:
+                if mtime >= racy:
+                    return None
+            key.append(mtime)
+        return tuple(key)
+
+    def _get_refs(self):
+        """Return a list of `(name, oid, commit_time)` for the branches and
+        tags which point to a commit, with tags peeled.
+
+        The list is cached until the references on disk are modified.
+        """
+        cache = self._refs_cache
+        if cache is not None:
+            key = self._get_refs_key(cache[1])
+            if key is not None and key == cache[0]:
+                return cache[2]
+
+        refs_dir = os.path.join(self.git_repos.path, 'refs')
+        refs_dirs = [refs_dir]
+        for name in ('heads', 'tags'):
+            refs_dirs.extend(dirpath for dirpath, dirnames, filenames
+                                     in os.walk(os.path.join(refs_dir, name)))
+        key = self._get_refs_key(refs_dirs)
+
+        git_repos = self.git_repos
+        if hasattr(git_repos, 'listall_reference_objects'):
+            references = ((ref.name, ref)
+                          for ref in git_repos.listall_reference_objects())
+        else:
+            references = ((name, None)
+                          for name in git_repos.listall_references())
+        refs = []
+        for name, ref in references:
+            # skip remotes, notes, stash, ... before reading any object
+            if not name.startswith(('refs/heads/', 'refs/tags/')):
+                continue
+            try:
+                if ref is None:
+                    ref = git_repos.lookup_reference(name)
+                git_object = ref.get_object()
+            except (KeyError, ValueError, pygit2.GitError):
+                continue
+            while git_object.type == GIT_OBJ_TAG:
+                git_object = git_object.get_object()
+            if git_object.type == GIT_OBJ_COMMIT:
+                refs.append((name, git_object.oid, git_object.commit_time))
+        self._refs_cache = (key, refs_dirs, refs)
+        return refs
+
+    def _get_ref_names(self):
+        """Return a dict which maps the short names of the branches and tags
+        to their commit oids. A branch wins over a tag with the same name.
+        """
+        refs = self._get_refs()
+        if self._ref_names is None or self._ref_names[0] is not refs:
+            _from_fspath = self._from_fspath
+            names = {}
+            for prefix in ('refs/heads/', 'refs/tags/'):
+                start = len(prefix)
+                for name, oid, commit_time in refs:
+                    if name.startswith(prefix):
+                        names.setdefault(_from_fspath(name[start:]), oid)
+            self._ref_names = (refs, names)
+        return self._ref_names[1]
+
     def _iter_ref_walkers(self, rev):
         git_repos = self.git_repos
         target = git_repos[rev]
+        target_time = target.commit_time
 
+        # walkers are shared by the branches which have the same tip
+        refs = self._get_refs()
         walkers = self._ref_walkers
-        for name in git_repos.listall_references():
+        if self._ref_walkers_refs is not refs:
+            tips = set(oid for name, oid, commit_time in refs
+                           if name.startswith('refs/heads/'))
+            for oid in list(walkers):
+                if oid not in tips:
+                    del walkers[oid]
+            self._ref_walkers_refs = refs
+
+        for name, oid, commit_time in refs:
             if not name.startswith('refs/heads/'):
                 continue
-            ref = git_repos.lookup_reference(name)
-            commit = self._get_commit(ref.target)
-            if not commit:
-                continue
-            if commit.commit_time < target.commit_time:
+            if commit_time < target_time:
                 continue
-            walker = walkers.get(name)
-            if walker and walker.rev != commit.hex:
-                walker = None
-            if not walker:
-                walkers[name] = walker = _CachedWalker(git_repos, commit.hex)
-            yield self._from_fspath(name), ref, walker
+            walker = walkers.get(oid)
+            if walker is None:
+                walkers[oid] = walker = _CachedWalker(git_repos, oid.hex)
+            yield self._from_fspath(name), oid, walker
 
     def _get_changes(self, parent_tree, commit_tree):
+        if parent_tree.oid == commit_tree.oid:
+            return []
         diff = parent_tree.diff_to_tree(commit_tree)
-        # don't detect rename if the diff has too many files
-        if len(diff) <= _diff_find_rename_limit or \
-                sum(patch.status == 'A'
-                    for patch in diff) <= _diff_find_rename_limit:
+        changes = list(_iter_changes_from_diff(diff))
+        # renames and copies need an added file, and don't detect them if
+        # the diff has too many files
+        n_added = sum(status == 'A' for old_path, new_path, status in changes)
+        limit = _diff_find_rename_limit
+        if n_added and (len(changes) <= limit or n_added <= limit):
             diff.find_similar()
+            changes = _iter_changes_from_diff(diff)
         _from_fspath = self._from_fspath
-        generator = ((_from_fspath(old_path), _from_fspath(new_path), status)
-                     for old_path, new_path, status
-                     in _iter_changes_from_diff(diff) if status in _status_map)
-        return sorted(generator, key=lambda item: item[1])
+        changes = [(_from_fspath(old_path), _from_fspath(new_path), status)
+                   for old_path, new_path, status in changes
+                   if status in _status_map]
+        changes.sort(key=itemgetter(1))
+        return changes
 
     def _get_branches(self, rev):
-        return sorted((name[11:], ref.target.hex)
-                      for name, ref, walker in self._iter_ref_walkers(rev)
-                      if rev in walker)
+        refs = self._get_refs()
+        if self._branches_cache is None or self._branches_cache[0] is not refs:
+            self._branches_cache = (refs, {})
+        cache = self._branches_cache[1]
+        branches = cache.get(rev)
+        if branches is None:
+            branches = sorted(self._iter_branches(rev, refs))
+            if len(cache) >= _branches_cache_size:
+                cache.clear()
+            cache[rev] = branches
+        return list(branches)
+
+    def _iter_branches(self, rev, refs):
+        git_repos = self.git_repos
+        if not hasattr(git_repos, 'descendant_of'):
+            for name, oid, walker in self._iter_ref_walkers(rev):
+                if rev in walker:
+                    yield name[11:], oid.hex
+            return
+
+        # let libgit2 check the reachability rather than walking each
+        # branch in Python
+        target = git_repos[rev]
+        target_oid = target.oid
+        target_time = target.commit_time
+        descendant_of = git_repos.descendant_of
+        for name, oid, commit_time in refs:
+            if not name.startswith('refs/heads/') or commit_time < target_time:
+                continue
+            if oid == target_oid or descendant_of(oid, target_oid):
+                yield self._from_fspath(name[11:]), oid.hex
 
     def _get_branches_cset(self, rev):
         return [(name, r == rev) for name, r in self._get_branches(rev)]
 
     def _get_tags_cset(self, rev):
-        git_repos = self.git_repos
-        _from_fspath = self._from_fspath
-
-        def iter_tags():
-            for name in git_repos.listall_references():
-                if not name.startswith('refs/tags/'):
-                    continue
-                ref = git_repos.lookup_reference(name)
-                git_object = ref.get_object()
-                if git_object.type == GIT_OBJ_TAG:
-                    git_object = git_object.get_object()
-                if rev == git_object.hex:
-                    yield _from_fspath(name[10:])
-
-        return sorted(iter_tags())
+        refs = self._get_refs()
+        if self._tags_by_rev is None or self._tags_by_rev[0] is not refs:
+            _from_fspath = self._from_fspath
+            tags = {}
+            for name, oid, commit_time in refs:
+                if name.startswith('refs/tags/'):
+                    name = _from_fspath(name[10:])
+                    tags.setdefault(oid.hex, []).append(name)
+            for names in tags.itervalues():
+                names.sort()
+            self._tags_by_rev = (refs, tags)
+        return list(self._tags_by_rev[1].get(rev, ()))
 
     def _resolve_rev(self, rev, raises=True):
         git_repos = self.git_repos
@@ -878,30 +1185,36 @@ class GitRepository(Repository):
                     raise NoSuchChangeset(rev)
                 return None
 
+        # commits never change, cache them by full sha1
+        cache = self._rev_cache
+        commit = cache.get(rev)
+        if commit is not None:
+            return commit
         commit = self._get_commit(rev)
         if commit:
+            if len(rev) == 40:
+                if len(cache) >= _rev_cache_size:
+                    cache.clear()
+                cache[rev] = commit
             return commit
 
-        for name in git_repos.listall_references():
-            ref = git_repos.lookup_reference(name)
-            name = self._from_fspath(name)
-            if name.startswith('refs/heads/'):
-                match = name[11:] == rev
-            elif name.startswith('refs/tags/'):
-                match = name[10:] == rev
-            else:
-                continue
-            if not match:
-                continue
-            commit = self._get_commit(ref.target)
-            if commit:
-                return commit
+        oid = self._get_ref_names().get(rev)
+        if oid is not None:
+            return git_repos[oid]
 
         if raises:
             raise NoSuchChangeset(rev)
 
     def close(self):
         self._ref_walkers.clear()
+        self._ref_walkers_refs = None
+        self._refs_cache = None
+        self._ref_names = None
+        self._tags_by_rev = None
+        self._branches_cache = None
+        self._tree_entry_cache.clear()
+        self._rev_cache.clear()
+        self._blame_cache.clear()
         self.git_repos = None
 
     def get_youngest_rev(self):
@@ -933,15 +1246,25 @@ class GitRepository(Repository):
     def short_rev(self, rev):
         rev = self.normalize_rev(rev)
         git_repos = self.git_repos
-        for size in xrange(self.shortrev_len, 40):
-            short_rev = rev[:size]
+
+        def is_unique(size):
             try:
-                git_object = git_repos[short_rev]
-                if git_object.type == GIT_OBJ_COMMIT:
-                    return short_rev
+                return git_repos[rev[:size]].type == GIT_OBJ_COMMIT
             except (KeyError, ValueError):
-                pass
-        return rev
+                return False
+
+        size = self.shortrev_len
+        if is_unique(size):
+            return rev[:size]
+        # a longer prefix stays unique, bisect the shortest one
+        low, high = size + 1, 40
+        while low < high:
+            mid = (low + high) // 2
+            if is_unique(mid):
+                high = mid
+            else:
+                low = mid + 1
+        return rev[:low]
 
     def display_rev(self, rev):
         return self.short_rev(rev)
@@ -954,46 +1277,40 @@ class GitRepository(Repository):
         return GitNode(self, self.normalize_path(path), commit)
 
     def get_quickjump_entries(self, rev):
-        git_repos = self.git_repos
-        refs = sorted(
-            (self._from_fspath(name), git_repos.lookup_reference(name))
-            for name in git_repos.listall_references()
-            if name.startswith('refs/heads/') or name.startswith('refs/tags/'))
+        refs = sorted((self._from_fspath(name), oid)
+                      for name, oid, commit_time in self._get_refs())
 
-        for name, ref in refs:
+        for name, oid in refs:
             if name.startswith('refs/heads/'):
-                commit = self._get_commit(ref.target)
-                if commit:
-                    yield 'branches', name[11:], '/', commit.hex
+                yield 'branches', name[11:], '/', oid.hex
 
-        for name, ref in refs:
+        for name, oid in refs:
             if name.startswith('refs/tags/'):
-                commit = self._get_commit(ref.target)
-                yield 'tags', name[10:], '/', commit.hex
+                yield 'tags', name[10:], '/', oid.hex
 
     def get_path_url(self, path, rev):
         return self.params.get('url')
 
     def get_changesets(self, start, stop):
-        seen_oids = set()
-
         def iter_commits():
             ts_start = to_timestamp(start)
             ts_stop = to_timestamp(stop)
-            git_repos = self.git_repos
-            for name in git_repos.listall_references():
-                if not name.startswith('refs/heads/'):
-                    continue
-                ref = git_repos.lookup_reference(name)
-                for commit in git_repos.walk(ref.target, _walk_flags):
-                    ts = commit.commit_time
-                    if ts < ts_start:
-                        break
-                    if ts_start <= ts <= ts_stop:
-                        oid = commit.oid
-                        if oid not in seen_oids:
-                            seen_oids.add(oid)
-                            yield ts, commit
+            tips = [oid for name, oid, commit_time in self._get_refs()
+                        if name.startswith('refs/heads/') and
+                           commit_time >= ts_start]
+            if not tips:
+                return
+            # a single walker from all the branches visits each commit once
+            # and yields them in time order
+            walker = self.git_repos.walk(tips[0], _walk_flags)
+            for oid in tips[1:]:
+                walker.push(oid)
+            for commit in walker:
+                ts = commit.commit_time
+                if ts < ts_start:
+                    break
+                if ts <= ts_stop:
+                    yield ts, commit
 
         for ts, commit in sorted(iter_commits(), key=lambda v: v[0],
                                  reverse=True):
@@ -1011,9 +1328,10 @@ class GitRepository(Repository):
 
         def iter_changes(old_commit, old_path, new_commit, new_path):
             old_tree = self._get_tree(old_commit.tree, old_path)
-            old_rev = old_commit.hex
             new_tree = self._get_tree(new_commit.tree, new_path)
-            new_rev = new_commit.hex
+            # both paths are normalized, without leading and trailing '/'
+            old_prefix = old_path and old_path + '/'
+            new_prefix = new_path and new_path + '/'
 
             for old_file, new_file, status in \
                     self._get_changes(old_tree, new_tree):
@@ -1022,11 +1340,11 @@ class GitRepository(Repository):
                     continue
                 old_node = new_node = None
                 if status != 'A':
-                    old_node = self.get_node(
-                                posixpath.join(old_path, old_file), old_rev)
+                    old_node = GitNode(self, old_prefix + old_file,
+                                       old_commit)
                 if status != 'D':
-                    new_node = self.get_node(
-                                posixpath.join(new_path, new_file), new_rev)
+                    new_node = GitNode(self, new_prefix + new_file,
+                                       new_commit)
                 yield old_node, new_node, Node.FILE, action
 
         old_commit = self._resolve_rev(old_rev)
@@ -1049,11 +1367,12 @@ class GitRepository(Repository):
         rev = self.normalize_rev(rev)
         path = self._to_fspath(self.normalize_path(path))
 
-        for name, ref, walker in self._iter_ref_walkers(rev):
+        for name, oid, walker in self._iter_ref_walkers(rev):
             if rev not in walker:
                 continue
+            target = pygit2.Oid(hex=str(rev))
             for commit in walker.reverse(rev):
-                if not any(p.hex == rev for p in commit.parents):
+                if target not in _get_parent_ids(commit):
                     continue
                 tree = commit.tree
                 entry = self._get_tree(tree, path)
@@ -1068,6 +1387,7 @@ class GitRepository(Repository):
                             entry.oid != parent_entry.oid:
                         return commit.hex
                 rev = commit.hex
+                target = commit.oid
 
     def parent_revs(self, rev):
         commit = self._resolve_rev(rev)
@@ -1075,15 +1395,16 @@ class GitRepository(Repository):
 
     def child_revs(self, rev):
         def iter_children(rev):
+            target = pygit2.Oid(hex=str(rev))
             seen = set()
-            for name, ref, walker in self._iter_ref_walkers(rev):
+            for name, oid, walker in self._iter_ref_walkers(rev):
                 if rev not in walker:
                     continue
                 for commit in walker.reverse(rev):
                     if commit.oid in seen:
                         break
                     seen.add(commit.oid)
-                    if any(p.hex == rev for p in commit.parents):
+                    if target in _get_parent_ids(commit):
                         yield commit
         return [c.hex for c in iter_children(self.normalize_rev(rev))]
 
@@ -1092,8 +1413,13 @@ class GitRepository(Repository):
         oid2 = self._resolve_rev(rev2).oid
         if oid1 == oid2:
             return False
+        git_repos = self.git_repos
+        if hasattr(git_repos, 'descendant_of'):
+            return git_repos.descendant_of(oid2, oid1)
+        if hasattr(git_repos, 'merge_base'):
+            return git_repos.merge_base(oid1, oid2) == oid1
         return any(oid1 == commit.oid
-                   for commit in self.git_repos.walk(oid2, _walk_flags))
+                   for commit in git_repos.walk(oid2, _walk_flags))
 
     def get_path_history(self, path, rev=None, limit=None):
         raise TracError(_("GitRepository does not support path_history"))
@@ -1184,31 +1510,47 @@ class GitNode(Node):
 
     def _walk_commits(self):
         skip_merges = self.isfile
-        _get_tree = self.repos._get_tree
         path = self.repos._to_fspath(self.path)
-        parent = parent_tree = None
-        for commit in self.repos.git_repos.walk(self.rev, _walk_flags):
-            if parent is not None and parent.oid == commit.oid:
-                tree = parent_tree
-            else:
-                tree = _get_tree(commit.tree, path)
-            parents = commit.parents
-            n_parents = len(parents)
+        if path:
+            _get_tree_entry = self.repos._get_tree_entry
+
+            # compare the oids of the entries, without reading the objects
+            def get_oid(tree):
+                entry = _get_tree_entry(tree, path)
+                if entry is not None and \
+                        _get_filemode(entry) != _filemode_submodule:
+                    return entry.oid
+        else:
+            get_oid = lambda tree: tree.oid
+        git_repos = self.repos.git_repos
+        parent = parent_oid = None
+        for commit in git_repos.walk(self.rev, _walk_flags):
+            parent_ids = _get_parent_ids(commit)
+            n_parents = len(parent_ids)
             if skip_merges and n_parents > 1:
                 continue
+            tree = commit.tree
+            if parent is not None and parent.oid == commit.oid:
+                oid = parent_oid
+            else:
+                oid = get_oid(tree)
             if n_parents == 0:
-                if tree is not None:
+                if oid is not None:
                     yield commit, Changeset.ADD
                 return
-            parent = parents[0]
-            parent_tree = _get_tree(parent.tree, path)
-            if tree is None:
-                if parent_tree is None:
+            parent = git_repos[parent_ids[0]]
+            parent_tree = parent.tree
+            if parent_tree.oid == tree.oid:
+                parent_oid = oid
+                continue
+            parent_oid = get_oid(parent_tree)
+            if oid is None:
+                if parent_oid is None:
                     continue
                 action = Changeset.DELETE
-            elif parent_tree is None:
+            elif parent_oid is None:
                 action = Changeset.ADD
-            elif parent_tree.oid != tree.oid:
+            elif parent_oid != oid:
                 action = Changeset.EDIT
             else:
                 continue
@@ -1228,13 +1570,23 @@ class GitNode(Node):
     def get_annotations(self):
         if not self.isfile:
             return
-        annotations = []
-        for hunk in self.repos.git_repos.blame(
-                self.repos._to_fspath(self.path),
-                newest_commit=self.commit.oid):
-            commit_id = str(hunk.final_commit_id)
-            annotations.extend([commit_id] * hunk.lines_in_hunk)
-        return annotations
+        repos = self.repos
+        path = repos._to_fspath(self.path)
+        # blame of a file at a given commit never changes
+        cache = repos._blame_cache
+        key = (self.commit.oid, path)
+        annotations = cache.get(key)
+        if annotations is None:
+            annotations = []
+            for hunk in repos.git_repos.blame(path,
+                                              newest_commit=self.commit.oid):
+                commit_id = str(hunk.final_commit_id)
+                annotations.extend([commit_id] * hunk.lines_in_hunk)
+            annotations = tuple(annotations)
+            if len(cache) >= _blame_cache_size:
+                cache.clear()
+            cache[key] = annotations
+        return list(annotations)
 
     def get_entries(self):
         if self.commit is None or self.tree is None or not self.isdir:
@@ -1247,8 +1599,7 @@ class GitNode(Node):
         path = repos._to_fspath(self.path)
         names = sorted(entry.name for entry in self.tree)
 
-        def get_entries(commit):
-            tree = _get_tree(commit.tree, path)
+        def get_entries(tree):
             if tree is None:
                 tree = ()
             return dict((entry.name, entry) for entry in tree)
@@ -1261,18 +1612,27 @@ class GitNode(Node):
 
         def get_commits():
             commits = {}
-            parent = parent_entries = None
+            parent = parent_tree = None
             for commit in git_repos.walk(self.rev, _walk_flags):
                 parents = commit.parents
                 n_parents = len(parents)
                 if n_parents == 0:
                     break
-                parent = parents[0]
-                if not parent and parent.oid == commit.oid:
-                    curr_entries = parent_entries
+                if parent is not None and parent.oid == commit.oid:
+                    curr_tree = parent_tree
                 else:
-                    curr_entries = get_entries(commit)
-                parent_entries = get_entries(parent)
+                    curr_tree = _get_tree(commit.tree, path)
+                parent = parents[0]
+                if parent.tree.oid == commit.tree.oid:
+                    parent_tree = curr_tree
+                    continue  # the whole tree is unchanged
+                parent_tree = _get_tree(parent.tree, path)
+                if curr_tree is None and parent_tree is None or \
+                        curr_tree is not None and parent_tree is not None and \
+                        curr_tree.oid == parent_tree.oid:
+                    continue  # no entries changed in the directory
+                curr_entries = get_entries(curr_tree)
+                parent_entries = get_entries(parent_tree)
                 for name in names:
                     if name in commits:
                         continue
@@ -1292,9 +1652,10 @@ class GitNode(Node):
             return commits
 
         commits = get_commits()
+        prefix = self.path and self.path + '/'
         for name in names:
-            yield GitNode(repos, posixpath.join(self.path, _from_fspath(name)),
-                          self.commit, created_commit=commits.get(name))
+            yield GitNode(repos, prefix + _from_fspath(name), self.commit,
+                          created_commit=commits.get(name))
 
     def get_content_type(self):
         if self.isdir:
@@ -25,7 +25,7 @@ def domain_options(domain, *options):
                         value = dgettext(doc_domain, value)
                     return value
             return OptionTx
-    return map(lambda option: _option_with_tx(option, domain), options)
+    return [_option_with_tx(option, domain) for option in options]
 
 
 TEXTDOMAIN = 'tracpygit2'